@@ -1,56 +1,62 @@
 import argparse
-import hashlib
+import heapq
+import itertools
 import random
-from dataclasses import dataclass
-from math import exp
+from math import log
 from typing import Optional
 
+# Kinds of simulation events, in the order they are processed within a single
+# second: first every block message due that second is delivered, then every
+# miner mines, and finally miners that received candidates pick their new tip.
+DELIVER = 0
+MINE = 1
+EVALUATE = 2
+
+class EventQueue:
+    __slots__ = ('events', 'sequence')
+
+    # A min-heap of (time, kind, sequence, target, block) events. The sequence
+    # number keeps events with the same time and kind in the order they were
+    # scheduled, and keeps heapq from ever comparing targets.
+    events: list[tuple[int, int, int, object, Optional['Block']]]
+
+    def __init__(self):
+        self.events = []
+        self.sequence = itertools.count()
+
+    def schedule(self, time: int, kind: int, target, block: Optional['Block'] = None):
+        heapq.heappush(self.events, (time, kind, next(self.sequence), target, block))
+
 # Each connection is only in one direction!
 class Connection:
+    __slots__ = ('sender', 'receiver', 'delay', 'events')
+
     sender: 'Miner'
     receiver: 'Miner'
     delay: int
+    events: EventQueue
 
-    @dataclass
-    class QueueEntry:
-        block: 'Block'
-        tts: int
-
-    # A queue of block messages to send, each with a countdown that is
-    # initialized to the delay.
-    blocks_to_send: list[QueueEntry]
-
-    def __init__(self, sender: 'Miner', receiver: 'Miner', delay: int):
-        self.blocks_to_send = []
+    def __init__(self, sender: 'Miner', receiver: 'Miner', delay: int, events: EventQueue):
         self.sender = sender
         self.receiver = receiver
         self.delay = delay
+        self.events = events
 
-    def queue_block(self, block: 'Block'):
-        self.blocks_to_send.append(self.QueueEntry(block, self.delay))
+    # Messages queued during second t go out with the next second's
+    # announcement phase, plus the connection's delay.
+    def queue_block(self, block: 'Block', time: int):
+        self.events.schedule(time + 1 + self.delay, DELIVER, self.receiver, block)
 
-    def send_block(self, block: 'Block'):
-        assert block.miner is not None
-        # print(f"{self.sender.name} sending block at height {block.height} mined by {block.miner.name} to {self.receiver.name}")
-        return self.receiver.receive_block(block)
-        
-    def tick(self):
-        if len(self.blocks_to_send) == 0:
-            return
-        remaining = []
-        for entry in self.blocks_to_send:
-            if entry.tts == 0:
-                self.send_block(entry.block)
-            else:
-                entry.tts -= 1
-                remaining.append(entry)
-        
-        self.blocks_to_send = remaining
+# Blocks only need a unique identity, not a real hash, so they are numbered
+# in the order they are created.
+_block_id = itertools.count()
 
 class Block:
+    __slots__ = ('height', 'time', 'id', 'miner', 'parent')
+
     height: int
     time: int
-    hash: str
+    id: int
     miner: Optional['Miner']
     parent: Optional['Block']
 
@@ -59,129 +65,190 @@ class Block:
         self.time = time
         self.miner = miner
         self.parent = parent
-        parent_hash:str = parent.hash if parent is not None else "0" * 64
-        preimage = f"{height}{miner}{parent_hash}"
-        self.hash = hashlib.sha256(preimage.encode('utf-8')).hexdigest()
+        self.id = next(_block_id)
 
 class Miner:
+    __slots__ = ('hashrate_proportion', 'log_miss_per_second',
+                 'current_block', 'name', 'block_candidates', 'connections', 'events',
+                 'known_ids', 'orphans_by_parent', 'blocks_mined', 'chain_by_miner')
+
     # proportion of global hashrate
     hashrate_proportion: float
+    log_miss_per_second: float
     current_block: Block
     name: str
     block_candidates: list[Block]
     connections: list[Connection]
-    known_blocks: dict[str, Block]
-    rejected_blocks: dict[str, Block]
+    events: EventQueue
+    # Ids of the blocks whose chain we have.
+    known_ids: set[int]
+    # Rejected blocks, keyed by the id of the missing parent they wait on.
+    orphans_by_parent: dict[int, list[Block]]
 
     # just for the stats
     blocks_mined: int
+    # How many blocks each miner has in our current chain, kept up to date as
+    # we switch tips so we don't have to walk the chain at the end.
+    chain_by_miner: dict['Miner', int]
 
-    def __init__(self, name, initial_block: Block, hashrate_proportion: float):
+    def __init__(self, name, initial_block: Block, hashrate_proportion: float, events: EventQueue):
         self.name = name
+        self.events = events
         self.blocks_mined = 0
+        self.chain_by_miner = {}
         self.current_block = initial_block
         self.hashrate_proportion = hashrate_proportion
         self.connections = []
-        self.known_blocks = {initial_block.hash: initial_block}
-        self.rejected_blocks = {}
+        self.known_ids = {initial_block.id}
+        self.orphans_by_parent = {}
         self.block_candidates = []
-        self.probability_per_second = self.hashrate_proportion * (1 - exp(-1/600))
+        # We find blocks as a Poisson process with a rate of
+        # hashrate_proportion / 600 per second, so the chance of not finding
+        # one in a given second is exp(-rate), and its log is just -rate.
+        self.log_miss_per_second = -self.hashrate_proportion / 600
 
     # Add connection to another miner with a given propagation delay.
     def add_connection(self, other: 'Miner', delay: int):
-        self.connections.append(Connection(self, other, delay))
+        self.connections.append(Connection(self, other, delay, self.events))
+
+    # Switch to a new tip, moving the counts in chain_by_miner from the blocks
+    # we leave behind to the blocks on the new branch.
+    def set_current_block(self, new_tip: Block):
+        chain_by_miner = self.chain_by_miner
+        old_tip = self.current_block
+        self.current_block = new_tip
+        while new_tip.height > old_tip.height:
+            chain_by_miner[new_tip.miner] = chain_by_miner.get(new_tip.miner, 0) + 1
+            new_tip = new_tip.parent
+        while old_tip.height > new_tip.height:
+            chain_by_miner[old_tip.miner] -= 1
+            old_tip = old_tip.parent
+        while old_tip is not new_tip:
+            chain_by_miner[new_tip.miner] = chain_by_miner.get(new_tip.miner, 0) + 1
+            chain_by_miner[old_tip.miner] -= 1
+            new_tip = new_tip.parent
+            old_tip = old_tip.parent
 
     def is_mine(self, block: Block):
-        return block.miner == self
+        return block.miner is self
 
-    # Sets current_block and clears block_candidates
+    # Picks a new current_block and clears block_candidates
     def evaluate_candidates(self):
-        # Filter candidates to those with the maximum height
-        max_height = max(block.height for block in self.block_candidates)
-        candidates_max_height = [block for block in self.block_candidates if block.height == max_height]
+        # Usually there is only one block to consider.
+        if len(self.block_candidates) == 1:
+            self.set_current_block(self.block_candidates[0])
+            self.block_candidates = []
+            return
+
+        # Collect the candidates with the maximum height in a single pass,
+        # noting whether one of them is ours.
+        max_height = -1
+        candidates_max_height: list[Block] = []
+        own_candidate: Optional[Block] = None
+        for block in self.block_candidates:
+            if block.height > max_height:
+                max_height = block.height
+                candidates_max_height = [block]
+                own_candidate = None
+            elif block.height == max_height:
+                candidates_max_height.append(block)
+            else:
+                continue
+            if own_candidate is None and self.is_mine(block):
+                own_candidate = block
+        self.block_candidates = []
 
         # Miners always pick their own for the same height.
-        for candidate in candidates_max_height:
-            if self.is_mine(candidate):
-                self.current_block = candidate
-                self.block_candidates = []
-                return
+        if own_candidate is not None:
+            self.set_current_block(own_candidate)
+            return
 
         # Choose randomly
-        self.current_block = random.choice(candidates_max_height)
-        self.block_candidates = []
+        self.set_current_block(candidates_max_height[random.randrange(len(candidates_max_height))])
+
+    # Queue a block to be considered as our next tip, scheduling an evaluation
+    # at the given time if one isn't already pending.
+    def add_candidate(self, block: Block, evaluate_time: int):
+        if len(self.block_candidates) == 0:
+            self.events.schedule(evaluate_time, EVALUATE, self)
+        self.block_candidates.append(block)
+
+    # Every second is an independent trial that fails with probability
+    # exp(log_miss_per_second), so the wait for our next block is
+    # geometrically distributed and can be drawn directly instead of rolling
+    # every second.
+    def schedule_next_block(self, time: int):
+        wait = int(log(1.0 - random.random()) / self.log_miss_per_second) + 1
+        self.events.schedule(time + wait, MINE, self)
 
     def mine(self, time):
         if len(self.block_candidates) > 0:
             self.evaluate_candidates()
-        if random.random() < self.probability_per_second:
-            found_block = Block(self.current_block.height + 1, time, self.current_block, self)
-            self.known_blocks[found_block.hash] = found_block
-            self.block_candidates.append(found_block)
-            self.announce(found_block)
-            # print(f"{self.name} found a block at height: {found_block.height}")
-
-    def announce(self, block: Block):
+        found_block = Block(self.current_block.height + 1, time, self.current_block, self)
+        self.known_ids.add(found_block.id)
+        # We normally switch to our own block in the next second, together
+        # with anything we hear about then. If an evaluation was already
+        # scheduled for this second it adopts our block right away instead.
+        # The outcome is the same, because a block at the same height arriving
+        # later would lose the tie to ours anyway.
+        self.add_candidate(found_block, time + 1)
+        self.announce(found_block, time)
+        self.schedule_next_block(time)
+        # print(f"{self.name} found a block at height: {found_block.height}")
+
+    def announce(self, block: Block, time: int):
         self.blocks_mined += 1
         for connection in self.connections:
-            connection.queue_block(block)
-
-    def send_messages(self):
-        for connection in self.connections:
-            connection.tick()
-
-    # This needs to happen any time we insert into known_blocks, could be more
-    # performant probably with a block arg, but this is easier to reason about
-    # by looping over everything.
-    def refresh_rejects(self):
-        moved: Optional[str] = None
-        for reject_hash, reject_block in self.rejected_blocks.items():
-            assert reject_block.parent is not None
-            if reject_block.parent.hash in self.known_blocks:
-                moved = reject_hash
-                self.known_blocks[reject_hash] = reject_block
-                break
-
-        if moved is not None:
-            self.rejected_blocks.pop(moved)
-            # We need to check back through the reject pile,
-            # since we just updated known_blocks.
-            self.refresh_rejects()
-
-
-    def receive_block(self, block: Block):
+            connection.queue_block(block, time)
+
+    # This needs to happen any time we insert into known_ids: any rejects
+    # waiting on the new block are now known, and so are any rejects waiting
+    # on those.
+    def connect_orphans(self, block: Block):
+        add_known = self.known_ids.add
+        pop_orphans = self.orphans_by_parent.pop
+        waiting = pop_orphans(block.id, [])
+        while waiting:
+            orphan = waiting.pop()
+            add_known(orphan.id)
+            waiting.extend(pop_orphans(orphan.id, []))
+
+    def receive_block(self, block: Block, time: int):
         # Only true for genesis, which we'll never receive.
         assert block.parent is not None
 
+        known_ids = self.known_ids
+
         # We've seen it before
-        if block.hash in self.known_blocks:
+        if block.id in known_ids:
             return
 
         # Reject blocks we don't have the chain for, this solves the following
         # complication: what if miner A's blocks have a 5s delay to us, and
         # miner B's blocks have 0s delay to us, but miner A finds a block and
         # miner B finds a child of that block before we have heard about A.
-        if block.parent.hash not in self.known_blocks:
-            self.rejected_blocks[block.hash] = block
+        if block.parent.id not in known_ids:
+            self.orphans_by_parent.setdefault(block.parent.id, []).append(block)
             return
 
-        self.known_blocks[block.hash] = block
-        self.refresh_rejects()
+        known_ids.add(block.id)
+        self.connect_orphans(block)
 
         # Anything above the current height is a candidate, anything with the
         # same height as current block is not a candidate, since we must have
         # received current earlier.
         if block.height > self.current_block.height:
-            self.block_candidates.append(block)
+            self.add_candidate(block, time)
 
         
 def main(block_periods_to_simulate: int):
     seconds_to_simulate = block_periods_to_simulate * 600
+    events = EventQueue()
     genesis_block = Block(0, 0, None, None)
     miners = [
-        Miner("A", genesis_block, 0.3), # "A" for "Attacker"
-        Miner("B", genesis_block, 0.3), # "B" for "Big guy"
-        Miner("C", genesis_block, 0.4)  # "C" for "Crud"
+        Miner("A", genesis_block, 0.3, events), # "A" for "Attacker"
+        Miner("B", genesis_block, 0.3, events), # "B" for "Big guy"
+        Miner("C", genesis_block, 0.4, events)  # "C" for "Crud"
     ]
 
     miners[0].add_connection(miners[1], 0)
@@ -193,30 +260,31 @@ def main(block_periods_to_simulate: int):
     miners[2].add_connection(miners[0], 0)
     miners[2].add_connection(miners[1], 0)
 
-    for t in range(1, seconds_to_simulate):
-        # First an announcement phase
-        for miner in miners:
-            miner.send_messages()
-        # Second, a mining phase
-        for miner in miners:
-            miner.mine(t)
-            
+    for miner in miners:
+        miner.schedule_next_block(0)
+
+    # Rather than ticking through every second, jump straight from one event
+    # to the next.
+    pending = events.events
+    next_event = heapq.heappop
+    while pending and pending[0][0] < seconds_to_simulate:
+        time, kind, _, target, block = next_event(pending)
+        if kind == DELIVER:
+            target.receive_block(block, time)
+        elif kind == MINE:
+            target.mine(time)
+        elif len(target.block_candidates) > 0:
+            target.evaluate_candidates()
 
     for i, miner in enumerate(miners):
         label = ["A (Attacker)", "B (Big guy)", "C (Crud)"][i]
         print(f"\nMiner {i} - {label}")
         print(f"  Hashrate proportion: {miner.hashrate_proportion:.1%}")
         print(f"  Current block height: {miner.current_block.height}")
-        print(f"  Total known blocks: {len(miner.known_blocks)}")
-        
-        # Count blocks mined by this miner in their main chain
-        blocks_in_chain = 0
-        block = miner.current_block
-        while block.parent is not None:
-            if block.miner == miner:
-                blocks_in_chain += 1
-            block = block.parent
+        print(f"  Total known blocks: {len(miner.known_ids)}")
         
+        # Blocks mined by this miner in their main chain
+        blocks_in_chain = miner.chain_by_miner.get(miner, 0)
         print(f"  Blocks by this miner in main chain: {blocks_in_chain}")
         print(f"  Blocks found by this miner: {miner.blocks_mined}")
         if miner.current_block.height > 0: